@@ -1,114 +1,300 @@
 import streamlit as st
+import httpx
+import json
+import logging
 import sqlite3
+import tiktoken
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from queue import LifoQueue
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Default system prompt for general assistance
 DEFAULT_SYSTEM_PROMPT = """You are a helpful, friendly, and knowledgeable AI assistant. You provide accurate,
 thoughtful, and well-structured responses to user questions across various topics. You are patient, professional,
 and always aim to give clear explanations. When you don't know something, you honestly admit it rather than
 making up information."""
 
+# System prompt templates, built once instead of on every rerun
+SYSTEM_PROMPT_TEMPLATES = {
+    "General Assistant": DEFAULT_SYSTEM_PROMPT,
+    "Healthcare Professional": """You are a knowledgeable healthcare professional AI assistant. You provide
+accurate medical information, health advice, and wellness guidance. You always remind users to consult
+with qualified healthcare providers for serious medical concerns. You are empathetic, clear, and focus
+on evidence-based information.""",
+    "Physiotherapy Expert": """You are an expert physiotherapy AI assistant. You provide guidance on
+physical therapy exercises, injury prevention, rehabilitation techniques, and musculoskeletal health.
+You explain exercises clearly with safety precautions and always recommend consulting a licensed
+physiotherapist for personalized treatment plans.""",
+    "Software Developer": """You are an experienced software developer AI assistant. You help with coding
+problems, debug issues, explain programming concepts, and provide best practices for software development.
+You write clean, well-commented code and explain technical concepts in an accessible way.""",
+    "Business Consultant": """You are a professional business consultant AI assistant. You provide strategic
+advice on business planning, management, marketing, finance, and organizational development. You offer
+practical solutions and insights based on business best practices.""",
+    "Education Tutor": """You are a patient and knowledgeable education tutor AI assistant. You help students
+understand complex topics, break down difficult concepts, and provide learning strategies. You adapt your
+explanations to different learning styles and encourage critical thinking.""",
+}
+
+# Number of queued messages that triggers a write before the end of a turn
+WRITE_BATCH_SIZE = 8
+
+# Number of most recent messages loaded, shown and sent to the model per chat
+MESSAGE_WINDOW = 50
+
+# Number of read-only connections that query alongside the writer
+READ_POOL_SIZE = 4
+
+# Token budget for the chat history sent with each request, newest messages first
+HISTORY_TOKEN_BUDGET = 4000
+
+# Minimum seconds between re-renders of a streaming response
+STREAM_RENDER_INTERVAL = 0.05
+
+# SQL statements
+INSERT_CHAT_SQL = "INSERT INTO chats (name, history_blob) VALUES (?, '[]')"
+SELECT_CHATS_SQL = 'SELECT id, name, created_at FROM chats ORDER BY created_at DESC'
+DELETE_CHAT_SQL = 'DELETE FROM chats WHERE id = ?'
+CHAT_EXISTS_SQL = 'SELECT 1 FROM chats WHERE id = ?'
+SELECT_HISTORY_BLOB_SQL = 'SELECT history_blob FROM chats WHERE id = ?'
+UPDATE_HISTORY_BLOB_SQL = 'UPDATE chats SET history_blob = ? WHERE id = ?'
+# Skips messages whose chat was deleted while they sat in the write queue;
+# flush_writes notices the shortfall and reports the dropped rows
+INSERT_MESSAGE_SQL = '''
+    INSERT INTO messages (chat_id, role, content)
+    SELECT ?1, ?2, ?3 WHERE EXISTS (SELECT 1 FROM chats WHERE id = ?1)
+'''
+SELECT_MESSAGES_SQL = '''
+    SELECT role, content FROM messages
+    WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+'''
+
 # Database setup
-def init_database():
+def init_database(conn):
     """Initialize SQLite database with required tables"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
-
-    # Create chats table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+    with conn:
+        cursor = conn.cursor()
+
+        # Create chats table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                history_blob TEXT
+            )
+        ''')
+
+        # Add the recent history column to databases created before it existed
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(chats)')}
+        if 'history_blob' not in columns:
+            cursor.execute('ALTER TABLE chats ADD COLUMN history_blob TEXT')
+
+        # Create messages table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+            )
+        ''')
+
+        # Index messages by chat so loading and deleting a chat avoid a full scan
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_ts
+            ON messages (chat_id, timestamp)
+        ''')
+
+@st.cache_resource
+def get_db():
+    """Open one SQLite connection per process, shared with a lock that serializes access"""
+    conn = sqlite3.connect('chatbot.db', check_same_thread=False)
+    conn.executescript('''
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -64000;
+        PRAGMA foreign_keys = ON;
+        PRAGMA wal_autocheckpoint = 1000;
     ''')
 
-    # Create messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
+    # Create the schema here so it runs once per process, not on every rerun
+    init_database(conn)
+    return conn, threading.Lock()
+
+@st.cache_resource
+def get_read_pool():
+    """Open read-only connections which, in WAL mode, never wait on the writer"""
+    # The writer connection creates the database and schema first
+    get_db()
+
+    pool = LifoQueue()
+    for _ in range(READ_POOL_SIZE):
+        conn = sqlite3.connect(
+            'file:chatbot.db?mode=ro',
+            uri=True,
+            check_same_thread=False
         )
-    ''')
+        conn.execute('PRAGMA cache_size = -16000')
+        pool.put(conn)
+    return pool
+
+@contextmanager
+def read_db():
+    """Borrow a read-only connection from the pool for the duration of a query"""
+    pool = get_read_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
 
-    conn.commit()
-    conn.close()
+@st.cache_resource
+def get_chat_list_version():
+    """Counter bumped whenever any session creates or deletes a chat"""
+    return [0]
 
 def create_new_chat():
     """Create a new chat session"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
+    conn, lock = get_db()
 
     chat_name = f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    cursor.execute('INSERT INTO chats (name) VALUES (?)', (chat_name,))
-    chat_id = cursor.lastrowid
-
-    conn.commit()
-    conn.close()
+    with lock, conn:
+        cursor = conn.execute(INSERT_CHAT_SQL, (chat_name,))
+        chat_id = cursor.lastrowid
+        get_chat_list_version()[0] += 1
 
     return chat_id
 
 def get_all_chats():
     """Retrieve all chat sessions"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
+    with read_db() as conn:
+        return conn.execute(SELECT_CHATS_SQL).fetchall()
 
-    cursor.execute('SELECT id, name, created_at FROM chats ORDER BY created_at DESC')
-    chats = cursor.fetchall()
-
-    conn.close()
-    return chats
+def get_chat_names():
+    """Map chat ids to names, newest first, ready for the sidebar's session cache"""
+    return {chat_id: chat_name for chat_id, chat_name, created_at in get_all_chats()}
 
 def delete_chat(chat_id):
-    """Delete a chat session and its messages"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
-
-    cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-    cursor.execute('DELETE FROM chats WHERE id = ?', (chat_id,))
-
-    conn.commit()
-    conn.close()
+    """Delete a chat session; its messages go with it via ON DELETE CASCADE"""
+    conn, lock = get_db()
+
+    # Write out queued messages first so none of them outlive their chat
+    flush_writes()
+
+    with lock, conn:
+        conn.execute(DELETE_CHAT_SQL, (chat_id,))
+        get_chat_list_version()[0] += 1
+
+@st.cache_resource
+def get_write_queue():
+    """Buffer of message rows waiting to be written, shared by every session"""
+    return []
+
+@st.cache_resource
+def get_dropped_chat_ids():
+    """Ids of deleted chats whose queued messages could not be saved"""
+    return set()
+
+def flush_writes():
+    """Write all queued messages and refresh their chats' recent history in one transaction"""
+    conn, lock = get_db()
+    queue = get_write_queue()
+
+    with lock:
+        if not queue:
+            return
+        with conn:
+            cursor = conn.executemany(INSERT_MESSAGE_SQL, queue)
+            chat_ids = {row[0] for row in queue}
+
+            # Fewer rows than queued means some chats were deleted meanwhile
+            if cursor.rowcount < len(queue):
+                missing = {
+                    chat_id for chat_id in chat_ids
+                    if conn.execute(CHAT_EXISTS_SQL, (chat_id,)).fetchone() is None
+                }
+                for chat_id, role, content in queue:
+                    if chat_id in missing:
+                        logger.warning(
+                            "Dropped %s message for deleted chat %s: %r",
+                            role, chat_id, content[:200]
+                        )
+                get_dropped_chat_ids().update(missing)
+                chat_ids -= missing
+
+            # Keep the last MESSAGE_WINDOW messages as JSON on the chat row so
+            # opening a chat reads one row instead of one per message
+            for chat_id in chat_ids:
+                rows = conn.execute(SELECT_MESSAGES_SQL, (chat_id, MESSAGE_WINDOW)).fetchall()
+                history = [{"role": role, "content": content} for role, content in reversed(rows)]
+                conn.execute(UPDATE_HISTORY_BLOB_SQL, (json.dumps(history), chat_id))
+        queue.clear()
+
+@st.cache_resource
+def get_db_writer():
+    """Single background thread that runs flush_writes() off the script thread"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="chatbot-db-writer")
+
+def log_flush_failure(future):
+    """Log a failed background flush; its rows stay queued for the next flush"""
+    error = future.exception()
+    if error is not None:
+        logger.error("Saving queued messages failed", exc_info=error)
 
 def save_message(chat_id, role, content):
-    """Save a message to the database"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
-
-    cursor.execute(
-        'INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)',
-        (chat_id, role, content)
-    )
-
-    conn.commit()
-    conn.close()
-
-def load_messages(chat_id):
-    """Load all messages for a specific chat"""
-    conn = sqlite3.connect('chatbot.db')
-    cursor = conn.cursor()
-
-    cursor.execute(
-        'SELECT role, content FROM messages WHERE chat_id = ? ORDER BY timestamp',
-        (chat_id,)
-    )
-    messages = cursor.fetchall()
-
-    conn.close()
-    return [{"role": role, "content": content} for role, content in messages]
-
+    """Queue a message for saving; it is written by the next flush_writes()"""
+    _, lock = get_db()
+    queue = get_write_queue()
+
+    with lock:
+        queue.append((chat_id, role, content))
+        should_flush = len(queue) >= WRITE_BATCH_SIZE
+
+    if should_flush:
+        flush_writes()
+
+def flush_turn(chat_id, partial_response):
+    """Queue the partial answer of an interrupted turn, then write everything queued"""
+    if partial_response:
+        save_message(chat_id, "assistant", partial_response)
+    flush_writes()
+
+def load_messages(chat_id, limit=MESSAGE_WINDOW):
+    """Load the most recent messages for a specific chat, oldest first"""
+    # Make sure messages still waiting in the queue are part of the result
+    flush_writes()
+
+    with read_db() as conn:
+        # The chat row holds the recent window; older history needs the messages table
+        if limit <= MESSAGE_WINDOW:
+            row = conn.execute(SELECT_HISTORY_BLOB_SQL, (chat_id,)).fetchone()
+            if row and row[0] is not None:
+                return json.loads(row[0])[-limit:]
+
+        cursor = conn.execute(SELECT_MESSAGES_SQL, (chat_id, limit))
+        messages = [{"role": role, "content": content} for role, content in cursor]
+
+    messages.reverse()
+    return messages
+
+@st.cache_resource(validate=lambda client: not client.is_closed())
 def get_azure_openai_client():
-    """Initialize Azure OpenAI client with error handling"""
+    """Initialize Azure OpenAI client once per process and reuse its connection pool"""
     try:
         # Get environment variables
         endpoint = os.getenv("AZURE_OPENAI_CHAT_ENDPOINT")
@@ -131,17 +317,77 @@ def get_azure_openai_client():
             st.info("Please add it to your .env file")
             st.stop()
 
+        # HTTP/2 so every turn reuses one multiplexed keep-alive connection; no explicit
+        # transport, which would make httpx ignore HTTP(S)_PROXY / NO_PROXY
+        http_client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            follow_redirects=True
+        )
+
         # Initialize and return client
         return AzureOpenAI(
             azure_endpoint=endpoint,
             api_key=api_key,
-            api_version=api_version
+            api_version=api_version,
+            http_client=http_client
         )
 
     except Exception as e:
         st.error(f"❌ Error initializing Azure OpenAI client: {str(e)}")
         st.stop()
 
+@st.cache_resource
+def start_token_encoder_load():
+    """Start loading the tokenizer in the background and return a Future for it"""
+    future = Future()
+
+    def load():
+        # tiktoken downloads the encoding on first use, with no request timeout
+        try:
+            future.set_result(tiktoken.get_encoding("o200k_base"))
+        except Exception as e:
+            future.set_exception(e)
+
+    # Daemon thread, so a download that never answers can't block shutdown
+    threading.Thread(target=load, name="tiktoken-loader", daemon=True).start()
+    return future
+
+def get_token_encoder():
+    """Return the tokenizer once it has loaded, or None while it is unavailable"""
+    future = start_token_encoder_load()
+    if not future.done():
+        logger.warning("Tokenizer still loading; estimating prompt tokens from length")
+        return None
+
+    error = future.exception()
+    if error is not None:
+        # Drop the failed load so the next turn retries instead of estimating forever
+        start_token_encoder_load.clear()
+        logger.warning("Tokenizer failed to load (%s); estimating prompt tokens from length", error)
+        return None
+
+    return future.result()
+
+def count_tokens(text, encoder):
+    """Count tokens in text, estimating four characters per token without a tokenizer"""
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text))
+
+def trim_messages(messages, token_budget=HISTORY_TOKEN_BUDGET):
+    """Keep the most recent messages that fit in the token budget, always keeping the last one"""
+    encoder = get_token_encoder()
+    used = 0
+    start = len(messages)
+    while start > 0:
+        # Every message also costs a few tokens of role and framing overhead
+        used += count_tokens(messages[start - 1]["content"], encoder) + 4
+        if used > token_budget and start < len(messages):
+            break
+        start -= 1
+    return messages[start:]
+
 def stream_chat_response(client, messages, deployment_name, system_prompt):
     """Stream response from Azure OpenAI with error handling"""
     try:
@@ -157,10 +403,12 @@ def stream_chat_response(client, messages, deployment_name, system_prompt):
         )
 
         for chunk in response:
-            if chunk.choices and len(chunk.choices) > 0:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    yield delta.content
+            # Azure sends chunks without choices (e.g. content filter results)
+            if not chunk.choices:
+                continue
+            content = getattr(chunk.choices[0].delta, 'content', None)
+            if content:
+                yield content
 
     except Exception as e:
         st.error(f"❌ Error generating response: {str(e)}")
@@ -187,23 +435,118 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# Initialize database
-init_database()
+def refresh_chat_list():
+    """Reload the cached chat list if any session created or deleted a chat since"""
+    version = get_chat_list_version()[0]
+    if st.session_state.get('chats_version') != version:
+        st.session_state.chats_cache = get_chat_names()
+        st.session_state.chats_version = version
+
+# Start fetching the tokenizer now so the first chat turn doesn't wait on it
+start_token_encoder_load()
 
 # Initialize session state
-if 'current_chat_id' not in st.session_state:
-    chats = get_all_chats()
+refresh_chat_list()
+
+if st.session_state.get('current_chat_id') not in st.session_state.chats_cache:
+    if 'current_chat_id' in st.session_state:
+        # Another session deleted the chat this one was on; reload below
+        if st.session_state.current_chat_id in get_dropped_chat_ids():
+            st.warning("This chat was deleted in another session, so your latest messages in it were not saved.")
+        else:
+            st.warning("This chat was deleted in another session.")
+        st.session_state.message_window = MESSAGE_WINDOW
+        del st.session_state.messages
+
+    chats = st.session_state.chats_cache
     if chats:
-        st.session_state.current_chat_id = chats[0][0]
+        st.session_state.current_chat_id = next(iter(chats))
     else:
         st.session_state.current_chat_id = create_new_chat()
+        refresh_chat_list()
+
+if 'message_window' not in st.session_state:
+    st.session_state.message_window = MESSAGE_WINDOW
 
 if 'messages' not in st.session_state:
-    st.session_state.messages = load_messages(st.session_state.current_chat_id)
+    st.session_state.messages = load_messages(
+        st.session_state.current_chat_id,
+        st.session_state.message_window
+    )
 
 if 'system_prompt' not in st.session_state:
     st.session_state.system_prompt = DEFAULT_SYSTEM_PROMPT
 
+# Widget callbacks, run before the rerun they trigger
+def load_older_messages():
+    """Grow the loaded history window of the current chat"""
+    st.session_state.message_window += MESSAGE_WINDOW
+    st.session_state.messages = load_messages(
+        st.session_state.current_chat_id,
+        st.session_state.message_window
+    )
+
+def select_chat():
+    """Load the history of the chat just picked in the sidebar"""
+    st.session_state.messages = load_messages(st.session_state.current_chat_id)
+    st.session_state.message_window = MESSAGE_WINDOW
+
+def delete_current_chat():
+    """Delete the selected chat and switch to another one or a new chat"""
+    chat_id = st.session_state.current_chat_id
+    delete_chat(chat_id)
+
+    # Switch to another chat or create new one
+    refresh_chat_list()
+    remaining_chats = st.session_state.chats_cache
+    st.session_state.message_window = MESSAGE_WINDOW
+    if remaining_chats:
+        st.session_state.current_chat_id = next(iter(remaining_chats))
+        st.session_state.messages = load_messages(st.session_state.current_chat_id)
+    else:
+        st.session_state.current_chat_id = create_new_chat()
+        st.session_state.messages = []
+
+# Fragments rerun on their own when their widgets change, skipping the rest of the page
+@st.fragment
+def render_system_prompt_settings():
+    """Sidebar system prompt settings; picking a template doesn't redraw the chat"""
+    with st.expander("⚙️ System Prompt Settings"):
+        st.markdown("**Customize AI Behavior**")
+        st.caption("Define how the AI assistant should respond")
+
+        # Predefined templates
+        prompt_template = st.selectbox(
+            "Select Template",
+            [*SYSTEM_PROMPT_TEMPLATES, "Custom"]
+        )
+
+        # Update system prompt based on selection
+        if prompt_template == "Custom":
+            custom_prompt = st.text_area(
+                "Enter Custom System Prompt",
+                value=st.session_state.system_prompt,
+                height=150,
+                help="Define how you want the AI to behave"
+            )
+            if st.button("Apply Custom Prompt"):
+                st.session_state.system_prompt = custom_prompt
+                st.success("✅ System prompt updated!")
+        else:
+            st.session_state.system_prompt = SYSTEM_PROMPT_TEMPLATES[prompt_template]
+            st.info(f"Using: {prompt_template}")
+
+@st.fragment
+def render_chat_history():
+    """Chat history; loading older messages redraws only this part of the page"""
+    # Offer older history when the loaded window may not hold the whole chat
+    if len(st.session_state.messages) >= st.session_state.message_window:
+        st.button("⬆️ Load older messages", on_click=load_older_messages)
+
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
 # Sidebar - Chat Management
 with st.sidebar:
     st.title("💬 Chat Sessions")
@@ -213,106 +556,41 @@ with st.sidebar:
         new_chat_id = create_new_chat()
         st.session_state.current_chat_id = new_chat_id
         st.session_state.messages = []
+        st.session_state.message_window = MESSAGE_WINDOW
         st.rerun()
 
     st.divider()
 
-    # Display all chats
-    chats = get_all_chats()
+    # Display all chats, kept current by refresh_chat_list() above
+    chats = st.session_state.chats_cache
 
     if chats:
         st.subheader("Your Conversations")
 
-        for chat_id, chat_name, created_at in chats:
-            col1, col2 = st.columns([4, 1])
-
-            with col1:
-                # Chat button - highlight current chat
-                button_type = "primary" if chat_id == st.session_state.current_chat_id else "secondary"
-                if st.button(
-                    chat_name,
-                    key=f"chat_{chat_id}",
-                    use_container_width=True,
-                    type=button_type
-                ):
-                    st.session_state.current_chat_id = chat_id
-                    st.session_state.messages = load_messages(chat_id)
-                    st.rerun()
-
-            with col2:
-                # Delete button
-                if st.button("🗑️", key=f"delete_{chat_id}", help="Delete this chat"):
-                    delete_chat(chat_id)
-
-                    # Switch to another chat or create new one
-                    remaining_chats = get_all_chats()
-                    if remaining_chats:
-                        st.session_state.current_chat_id = remaining_chats[0][0]
-                        st.session_state.messages = load_messages(remaining_chats[0][0])
-                    else:
-                        st.session_state.current_chat_id = create_new_chat()
-                        st.session_state.messages = []
-
-                    st.rerun()
+        # One radio bound to current_chat_id replaces a pair of buttons per chat;
+        # the cached id -> name map serves as both options and labels
+        st.radio(
+            "Your Conversations",
+            options=chats,
+            format_func=chats.get,
+            key="current_chat_id",
+            on_change=select_chat,
+            label_visibility="collapsed"
+        )
+
+        st.button(
+            "🗑️ Delete Chat",
+            on_click=delete_current_chat,
+            use_container_width=True,
+            help="Delete the selected chat"
+        )
     else:
         st.info("No chats yet. Start a new conversation!")
 
     st.divider()
 
     # System Prompt Configuration
-    with st.expander("⚙️ System Prompt Settings"):
-        st.markdown("**Customize AI Behavior**")
-        st.caption("Define how the AI assistant should respond")
-
-        # Predefined templates
-        prompt_template = st.selectbox(
-            "Select Template",
-            [
-                "General Assistant",
-                "Healthcare Professional",
-                "Physiotherapy Expert",
-                "Software Developer",
-                "Business Consultant",
-                "Education Tutor",
-            ]
-        )
-
-        # # System prompt templates
-        # templates = {
-        #     "General Assistant": DEFAULT_SYSTEM_PROMPT,
-        #     "Healthcare Professional": """You are a knowledgeable healthcare professional AI assistant. You provide
-        #     accurate medical information, health advice, and wellness guidance. You always remind users to consult
-        #     with qualified healthcare providers for serious medical concerns. You are empathetic, clear, and focus
-        #     on evidence-based information.""",
-        #     "Physiotherapy Expert": """You are an expert physiotherapy AI assistant. You provide guidance on
-        #     physical therapy exercises, injury prevention, rehabilitation techniques, and musculoskeletal health.
-        #     You explain exercises clearly with safety precautions and always recommend consulting a licensed
-        #     physiotherapist for personalized treatment plans.""",
-        #     "Software Developer": """You are an experienced software developer AI assistant. You help with coding
-        #     problems, debug issues, explain programming concepts, and provide best practices for software development.
-        #     You write clean, well-commented code and explain technical concepts in an accessible way.""",
-        #     "Business Consultant": """You are a professional business consultant AI assistant. You provide strategic
-        #     advice on business planning, management, marketing, finance, and organizational development. You offer
-        #     practical solutions and insights based on business best practices.""",
-        #     "Education Tutor": """You are a patient and knowledgeable education tutor AI assistant. You help students
-        #     understand complex topics, break down difficult concepts, and provide learning strategies. You adapt your
-        #     explanations to different learning styles and encourage critical thinking.""",
-        # }
-
-        # # Update system prompt based on selection
-        # if prompt_template == "Custom":
-        #     custom_prompt = st.text_area(
-        #         "Enter Custom System Prompt",
-        #         value=st.session_state.system_prompt,
-        #         height=150,
-        #         help="Define how you want the AI to behave"
-        #     )
-        #     if st.button("Apply Custom Prompt"):
-        # #         st.session_state.system_prompt = custom_prompt
-        # #         st.success("✅ System prompt updated!")
-        # else:
-        #     st.session_state.system_prompt = templates[prompt_template]
-        #     st.info(f"Using: {prompt_template}")
+    render_system_prompt_settings()
 
     st.divider()
     st.caption("Powered by Azure OpenAI")
@@ -323,9 +601,7 @@ st.markdown("##### 💡 Customize the system prompt to make the AI specialize in
 st.caption("Ask me anything - I'm here to help!")
 
 # Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+render_chat_history()
 
 # Chat input
 if prompt := st.chat_input("Ask me anything..."):
@@ -337,43 +613,68 @@ if prompt := st.chat_input("Ask me anything..."):
         st.info("Please add it to your .env file")
         st.stop()
 
-    # Add user message to chat
+    # Resolved up front: once st.stop() or a rerun is pending, any further
+    # Streamlit call raises, and the finally below must still queue the flush
+    db_writer = get_db_writer()
+    chat_id = st.session_state.current_chat_id
+
+    # Add user message to chat and commit it in the background while the answer streams
     st.session_state.messages.append({"role": "user", "content": prompt})
-    save_message(st.session_state.current_chat_id, "user", prompt)
+    save_message(chat_id, "user", prompt)
+    db_writer.submit(flush_writes).add_done_callback(log_flush_failure)
 
     # Display user message
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Get Azure OpenAI client
-    client = get_azure_openai_client()
-
     # Generate and stream assistant response
     with st.chat_message("assistant"):
         response_placeholder = st.empty()
-        full_response = ""
+        response_parts = []
+        last_render = time.monotonic()
+        assistant_saved = False
 
         try:
+            # Get Azure OpenAI client; it may st.stop(), which still runs the flush below
+            client = get_azure_openai_client()
+
             # Stream the response with system prompt
             for chunk in stream_chat_response(
                 client,
-                st.session_state.messages,
+                trim_messages(st.session_state.messages[-st.session_state.message_window:]),
                 deployment_name,
                 st.session_state.system_prompt
             ):
-                full_response += chunk
-                response_placeholder.markdown(full_response + "▌")
+                response_parts.append(chunk)
+
+                # Throttle re-rendering so long answers don't redraw on every token
+                now = time.monotonic()
+                if now - last_render >= STREAM_RENDER_INTERVAL:
+                    response_placeholder.markdown("".join(response_parts) + "▌")
+                    last_render = now
 
             # Remove cursor and display final response
+            full_response = "".join(response_parts)
             response_placeholder.markdown(full_response)
 
             # Save assistant message if response was generated
             if full_response:
                 st.session_state.messages.append({"role": "assistant", "content": full_response})
-                save_message(st.session_state.current_chat_id, "assistant", full_response)
+                save_message(chat_id, "assistant", full_response)
+                assistant_saved = True
             else:
                 st.warning("No response generated. Please try again.")
 
         except Exception as e:
             st.error(f"❌ An error occurred: {str(e)}")
             st.info("Please check your Azure OpenAI configuration and try again.")
+
+        finally:
+            # A sidebar click mid-stream interrupts the loop above; keep what was
+            # streamed so far instead of dropping it
+            partial_response = None if assistant_saved else "".join(response_parts)
+            if partial_response:
+                st.session_state.messages.append({"role": "assistant", "content": partial_response})
+
+            # Commit in the background; any later read flushes first and waits on the same lock
+            db_writer.submit(flush_turn, chat_id, partial_response).add_done_callback(log_flush_failure)